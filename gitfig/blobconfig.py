@@ -1,4 +1,4 @@
-#!/usr/bin/python2.7
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 # vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
 
@@ -18,21 +18,41 @@
 Basic configuration holder objects.
 
 """
-from __future__ import absolute_import
-from __future__ import print_function
-from __future__ import unicode_literals
-from __future__ import division
-
+import atexit
+import copyreg
+import getpass
 import json
 import shutil
+import stat
 import sys, os
 import tempfile
+import threading
+import time
 import warnings
-from datetime import datetime, timedelta
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha1
 
 import git
 import yaml
 
+try:
+    import fcntl
+except ImportError:  # windows, fetches are only serialized within a process
+    fcntl = None
+
+try:
+    from yaml import CSafeLoader as _SafeLoader
+except ImportError:
+    from yaml import SafeLoader as _SafeLoader
+
+# msgspec decodes json faster when installed; orjson is not used as it
+# silently turns ints wider than 64 bits into floats
+try:
+    from msgspec.json import decode as _json_loads
+except ImportError:
+    _json_loads = None
+
 
 class BasicConfigError(Exception):
     pass
@@ -44,20 +64,93 @@ class ConfigReadError(BasicConfigError):
     pass
 
 
-def blob_readable(blob):
-    fn, ext = os.path.splitext(blob.name)
-    return ext in ['.py', '.conf', '.yaml', '.yml', '.json']
+# (blob hexsha, path) -> compiled code, blobs are content addressed so entries
+# never go stale; the path is part of the key as compile bakes it in for tracebacks
+_code_cache = {}
+
+def _exec_py(blob, glbl, loc):
+    key = (blob.hexsha, blob.path)
+    code = _code_cache.get(key)
+    if code is None:
+        # compile takes the source bytes directly, no need for a decoded copy
+        code = _code_cache[key] = compile(blob.data_stream.read(), blob.path, 'exec')
+    # run against a plain dict so each assignment skips loc's __setitem__,
+    # then merge everything back at once
+    ns = dict(loc)
+    exec(code, glbl, ns)
+    loc.update(ns)
+
+def _load_yaml(blob, glbl, loc):
+    loc.update(yaml.load(blob.data_stream, Loader=_SafeLoader))
+
+def _decode_json(data):
+    if _json_loads is not None:
+        try:
+            return _json_loads(data)
+        except ValueError:
+            # stdlib json also takes a BOM and NaN/Infinity, don't let a
+            # config depend on msgspec being installed
+            pass
+    return json.loads(data)
+
+def _load_json(blob, glbl, loc):
+    c, source = read_json(blob)
+    loc.update(c)
+
+_HANDLERS = {
+    '.py': _exec_py,
+    '.conf': _exec_py,
+    '.yaml': _load_yaml,
+    '.yml': _load_yaml,
+    '.json': _load_json,
+}
+
+# key `gitfig-precompile` marks its JSON twins with, the value is the git
+# blob sha of the yaml file the twin was generated from
+TWIN_KEY = '__gitfig_source__'
+
+def json_twin(name):
+    """json_twin(name) -> str or None
+    Name of the JSON file `gitfig-precompile` generates next to a yaml
+    config, None if `name` is not a yaml file.
+    """
+    base, dot, ext = name.rpartition('.')
+    if base and ext in ('yaml', 'yml'):
+        return base + '.json'
+    return None
+
+def read_json(blob):
+    """read_json(blob) -> (contents, source)
+    Decode a JSON config blob, `source` is the git blob sha of the yaml
+    file it was precompiled from, None for a regular JSON config.
+    """
+    c = _decode_json(blob.data_stream.read())
+    source = c.pop(TWIN_KEY, None) if isinstance(c, dict) else None
+    return c, source
+
+def read_twin(blob, twin):
+    """read_twin(blob, twin) -> dict or None
+    Contents of the JSON `twin` blob if it was generated from this very
+    yaml `blob`, None for handwritten or stale JSON files.
+    """
+    try:
+        c, source = read_json(twin)
+    except ValueError:
+        return None
+    return c if source == blob.hexsha else None
+
+def _handler(name):
+    dot = name.rfind('.')
+    return _HANDLERS.get(name[dot:]) if dot > 0 else None
 
 def read_blob(blob, glbl, loc):
-    fn, ext = os.path.splitext(blob.name)
-    if ext in ['.py', '.conf']:
-        exec(blob.data_stream.read().decode(), glbl, loc)
-    elif ext in ['.yaml', '.yml']:
-        c = yaml.safe_load(blob.data_stream)
-        loc.update(c)
-    elif ext in ['.json']:
-        c = json.load(blob.data_stream)
-        loc.update(c)
+    """Merge `blob` into `loc` according to its extension, returns False
+    if it is not a config file."""
+    handler = _handler(blob.name)
+    if handler is None:
+        return False
+    handler(blob, glbl, loc)
+    return True
 
 def get_pathname(basename):
     if isinstance(basename, list):
@@ -70,41 +163,58 @@ class ConfigHolder(dict):
 it maps attribute access to the real dictionary. This object is lockable, use
 the 'lock' and 'unlock' methods to set its state. If locked, new keys or
 attributes cannot be added, but existing ones may be changed."""
+    # class default so the flag resolves before __init__/__setstate__ ran
+    _locked = 0
+
     def __init__(self, init={}, name=None):
         name = name or self.__class__.__name__.lower()
         dict.__init__(self, init)
         dict.__setattr__(self, "_locked", 0)
         dict.__setattr__(self, "_name", name)
 
+    def __reduce_ex__(self, protocol):
+        # contents travel in the state, restoring them must not trip the lock
+        return copyreg.__newobj__, (self.__class__,), self.__getstate__()
+
     def __getstate__(self):
-        return self.__dict__.items()
+        return dict(self), list(self.__dict__.items())
 
-    def __setstate__(self, items):
+    def __setstate__(self, state):
+        data, items = state
+        dict.update(self, data)
         for key, val in items:
             self.__dict__[key] = val
 
     def __repr__(self):
-        return "%s(%s)" % (self.__class__.__name__, dict.__repr__(self))
+        return f"{self.__class__.__name__}({dict.__repr__(self)})"
 
     def __str__(self):
         n = self._name
-        s = ["{}(name={!r}):".format(self.__class__.__name__, n)]
-        s = s + ["  {}.{} = {!r}".format(n, it[0], it[1]) for it in self.items()]
+        s = [f"{self.__class__.__name__}(name={n!r}):"]
+        s = s + [f"  {n}.{key} = {val!r}" for key, val in self.items()]
         s.append("\n")
         return "\n".join(s)
 
     def __setitem__(self, key, value):
         if self._locked and not key in self:
             raise ConfigLockError("setting attribute on locked config holder")
-        return super(ConfigHolder, self).__setitem__(key, value)
-
-    def __getitem__(self, name):
-        return super(ConfigHolder, self).__getitem__(name)
-
-    def __delitem__(self, name):
-        return super(ConfigHolder, self).__delitem__(name)
+        dict.__setitem__(self, key, value)
+
+    def update(self, *args, **kwargs):
+        if self._locked:
+            other = dict(*args, **kwargs)
+            if any(key not in self for key in other):
+                raise ConfigLockError("setting attribute on locked config holder")
+            return dict.update(self, other)
+        return dict.update(self, *args, **kwargs)
+
+    def __getattr__(self, name):
+        # only called when normal lookup fails, i.e. for config keys
+        try:
+            return dict.__getitem__(self, name)
+        except KeyError:
+            raise AttributeError(name)
 
-    __getattr__ = __getitem__
     __setattr__ = __setitem__
 #    __delattr__ = __delitem__
 
@@ -136,38 +246,210 @@ class SECTION(ConfigHolder):
         return super(SECTION, self).__str__()
 
 
+# removes cleaned up clones off the caller's path
+_cleaner = ThreadPoolExecutor(max_workers=2)
+atexit.register(_cleaner.shutdown, wait=True)
+
+def _cache_dir():
+    """Per user directory holding the clones, refuses one other users
+    could have written to since config blobs end up being exec'd."""
+    uid = os.getuid() if hasattr(os, 'getuid') else None
+    path = os.path.join(tempfile.gettempdir(), f"gitfig-{uid if uid is not None else getpass.getuser()}")
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or uid is not None and (st.st_uid != uid or st.st_mode & 0o077):
+        raise BasicConfigError(f"unsafe gitfig cache directory {path!r}.")
+    return path
+
+def _discard(path):
+    """Move `path` out of the way at once and remove it in the background."""
+    trash = tempfile.mkdtemp(prefix='trash-', dir=_cache_dir())
+    try:
+        os.rename(path, os.path.join(trash, 'repo'))
+    except FileNotFoundError:
+        pass
+    _cleaner.submit(shutil.rmtree, trash, ignore_errors=True)
+
+def _clone(repo_path, repo_dir):
+    # configs are read straight from the object db, so skip the
+    # checkout and let git lazily fetch only the blobs we read
+    git.Repo.clone_from(repo_path, repo_dir, multi_options=[
+        '--no-checkout', '--filter=blob:none', '--depth=1', '--no-single-branch',
+    ]).close()
+
+def _open_clone(repo_dir, repo_path):
+    """Open the clone at `repo_dir`, None unless it is a clone of `repo_path`."""
+    try:
+        repo = git.Repo(repo_dir)
+    except (git.NoSuchPathError, git.InvalidGitRepositoryError):
+        return None
+    if next((r.url for r in repo.remotes if r.name == 'origin'), None) != repo_path:
+        repo.close()
+        return None
+    return repo
+
+# repo_path -> RepoObject, shared by every config read from the same repo
+_repos = {}
+# repo_path -> lock held while its RepoObject is created, so a slow clone
+# only blocks callers of the same repo
+_repo_locks = {}
+_repos_lock = threading.Lock()
+
+def get_repo(repo_path):
+    """get_repo(repo_path) -> RepoObject
+    Return the cached RepoObject for `repo_path`, creating it on first use.
+    """
+    with _repos_lock:
+        lock = _repo_locks.setdefault(repo_path, threading.Lock())
+    with lock:
+        repo = _repos.get(repo_path)
+        if repo is None:
+            repo = _repos[repo_path] = RepoObject(repo_path, shared=True)
+            return repo
+    repo.sync()
+    return repo
+
+
 class RepoObject(object):
-    def __init__(self, repo_path=None, branch='master'):
+    """RepoObject(repo_path, branch, shared) Opens `repo_path` if it is a
+local repo, clones it otherwise. A shared clone lives at a stable path
+per uri so later calls and processes reuse it, and is never cleaned up.
+A private clone is removed by 'cleanup'."""
+    # minimum seconds between fetches
+    fetch_interval = 20
+
+    def __init__(self, repo_path=None, branch='master', shared=False):
+        stale = False
         try:
             repo = git.Repo(repo_path)
         except (git.NoSuchPathError, git.InvalidGitRepositoryError):
-            repo_dir = tempfile.mkdtemp()
-            repo = git.Repo.clone_from(repo_path, repo_dir)
+            if shared:
+                repo_dir = os.path.join(_cache_dir(), sha1(repo_path.encode()).hexdigest())
+                repo = _open_clone(repo_dir, repo_path)
+                stale = repo is not None
+                if repo is None:
+                    repo = self._clone_shared(repo_path, repo_dir)
+            else:
+                repo_dir = tempfile.mkdtemp(prefix='private-', dir=_cache_dir())
+                _clone(repo_path, repo_dir)
+                repo = git.Repo(repo_dir)
             self._repo_dir = repo_dir
+            self._cloned = not shared
         else:
             self._repo_dir = repo_path
+            self._cloned = False
+        self._repo_path = repo_path
         self._repo = repo
-        self._last_fetch = datetime.now()
+        self._last_fetch = time.monotonic()
+        self._fetch_lock = threading.Lock()
+        # held while reading objects, BlobConfigs share one RepoObject
+        self.lock = threading.RLock()
         self._branch = branch
+        self._load_refs()
+        if stale:
+            self._last_fetch -= self.fetch_interval
+            self.sync()
+
+    @staticmethod
+    def _clone_shared(repo_path, repo_dir):
+        # clone next to the final path and rename it into place, so other
+        # threads or processes never see (or delete) a half done clone
+        tmp = tempfile.mkdtemp(prefix='clone-', dir=os.path.dirname(repo_dir))
+        try:
+            _clone(repo_path, tmp)
+            try:
+                os.rename(tmp, repo_dir)
+            except OSError:
+                # someone else got there first, use theirs if it is sound
+                repo = _open_clone(repo_dir, repo_path)
+                if repo is not None:
+                    return repo
+                _discard(repo_dir)
+                os.rename(tmp, repo_dir)
+        finally:
+            if os.path.exists(tmp):
+                _discard(tmp)
+        return git.Repo(repo_dir)
+
+    def _load_refs(self):
+        # list each remote's own refs instead of filtering every ref and tag,
+        # on a branch name clash the first remote (origin for clones) wins
+        refs = {}
+        for remote in self._repo.remotes:
+            for r in remote.refs:
+                refs.setdefault(r.remote_head, r)
+        self._remote_refs = refs
 
     def get_ref(self, branch=None):
-        if branch is None:
-            branch = self._branch
-        return {r.remote_head: r for r in self._repo.refs if isinstance(r, git.RemoteReference)}[branch]
+        return self._remote_refs[branch or self._branch]
 
     def sync(self):
-        # how to avoid multiple fetch requests?
-        # lock config until sync is done?
-        # if datetime.now() >= self._last_fetch + timedelta(minutes=5):
-        if datetime.now() >= self._last_fetch + timedelta(seconds=20):
-            for remote in self._repo.remotes:
-                remote.fetch()
-            self._last_fetch = datetime.now()
+        if time.monotonic() - self._last_fetch < self.fetch_interval:
+            return
+        # only one thread fetches, the others keep reading the current refs
+        if not self._fetch_lock.acquire(blocking=False):
+            return
+        try:
+            if time.monotonic() - self._last_fetch < self.fetch_interval:
+                return
+            remotes = [r.name for r in self._repo.remotes]
+            if remotes:
+                try:
+                    self._fetch(remotes)
+                except git.GitCommandError as ex:
+                    warnings.warn(f"RepoObject: fetching {self._repo_path} failed, keeping current refs: {ex}")
+                else:
+                    # the objects the refs resolve to are read through the
+                    # same cat-file pipes BlobConfigs use under `lock`
+                    with self.lock:
+                        self._load_refs()
+            self._last_fetch = time.monotonic()
+        finally:
+            self._fetch_lock.release()
+
+    def _fetch(self, remotes):
+        # other processes may share this clone: fetch under a lock file and
+        # skip the network if one of them fetched while we waited for it
+        with open(os.path.join(self._repo.git_dir, 'gitfig-fetch.lock'), 'w') as lockfile:
+            waiting = time.time()
+            if fcntl is not None:
+                fcntl.flock(lockfile, fcntl.LOCK_EX)
+            try:
+                if os.stat(os.path.join(self._repo.git_dir, 'FETCH_HEAD')).st_mtime >= waiting:
+                    return
+            except FileNotFoundError:
+                pass
+            if len(remotes) == 1:
+                self._repo.git.fetch(remotes[0])
+            else:
+                # one git process for every remote
+                self._repo.git.fetch('--multiple', '--jobs=4', *remotes)
+
+    def prefetch(self, tree, blobs):
+        """Fetch the `blobs` of `tree` missing from a partial clone in a
+        single request, instead of git lazily fetching them one by one."""
+        remote = next((r.name for r in self._repo.remotes if r.config_reader.get_value('promisor', False)), None)
+        if remote is None:
+            return
+        wanted = {blob.hexsha for blob in blobs}
+        missing = [line[1:] for line in self._repo.git.rev_list('--objects', '--missing=print', tree.hexsha).splitlines()
+                   if line.startswith('?') and line[1:] in wanted]
+        if missing:
+            # same invocation git itself uses for lazy fetches; it is only an
+            # optimisation (e.g. --no-write-fetch-head needs git 2.29), on
+            # failure git still fetches each blob lazily when it is read
+            try:
+                self._repo.git(c='fetch.negotiationAlgorithm=noop').fetch(
+                    remote, '--no-tags', '--no-write-fetch-head', '--recurse-submodules=no', '--filter=blob:none',
+                    *missing)
+            except git.GitCommandError:
+                pass
 
     def cleanup(self):
-        if not self._repo_dir.startswith(tempfile.gettempdir()):
+        if not self._cloned:
             return
-        shutil.rmtree(self._repo_dir)
+        self._repo.close()
+        _discard(self._repo_dir)
 
 
 class BlobConfig(ConfigHolder):
@@ -175,28 +457,104 @@ class BlobConfig(ConfigHolder):
     # raise ConfigReadError("did not find %r." % (fpath,))
     # raise ConfigReadError("did not successfully read %r." % (fpath,))
 
-    def set_repo(self, repo_path=None, branch='master'):
-        dict.__setattr__(self, '_repo', RepoObject(repo_path, branch))
+    def set_repo(self, repo_path=None, branch='master', shared=True):
+        repo = get_repo(repo_path) if shared else RepoObject(repo_path, branch)
+        dict.__setattr__(self, '_repo', repo)
+        dict.__setattr__(self, '_branch', branch)
+        # fpath -> (commit hexsha, globalspace) of the last merge
+        dict.__setattr__(self, '_synced', {})
 
     def get_dynamic(self, key):
         self._repo.sync()
+        with self._repo.lock:
+            hexsha = self._repo.get_ref(self._branch).commit.hexsha
+            for fpath, (synced, globalspace) in list(self._synced.items()):
+                if synced != hexsha:
+                    self.sync_config(fpath, globalspace)
         return self[key]
 
     def sync_config(self, fname, globalspace=None):
         fpath = get_pathname(fname)
-        ref = self._repo.get_ref()
-        tree = ref.commit.tree
-        for item in tree.traverse():
-            if item.path == fpath:
-                if item.type == 'blob':
+        # the shared repo's git object readers are not thread safe
+        with self._repo.lock:
+            commit = self._repo.get_ref(self._branch).commit
+            if self._synced.get(fpath, (None,))[0] == commit.hexsha:
+                return
+            item = parent = commit.tree
+            for part in fpath.strip('/').split('/'):
+                if not part:
+                    continue
+                try:
+                    if item.type != 'tree':
+                        raise KeyError(part)
+                    parent, item = item, item[part]
+                except KeyError:
+                    raise ConfigReadError(f"did not find {fpath!r}.")
+            if item.type == 'blob':
+                twin = self._find_twin(parent, item)
+                if twin is not None:
+                    self.mergedata(item, twin)
+                else:
                     self.mergeblob(item, globalspace)
-                elif item.type == 'tree':
-                    self.mergetree(item, globalspace)
+            elif item.type == 'tree':
+                self.mergetree(item, globalspace)
+            self._synced[fpath] = (commit.hexsha, globalspace)
+
+    @staticmethod
+    def _find_twin(tree, blob):
+        """Contents of the precompiled JSON twin of a yaml `blob` in `tree`,
+        None if there is no up to date one."""
+        name = json_twin(blob.name)
+        if name is None:
+            return None
+        try:
+            twin = tree[name]
+        except KeyError:
+            return None
+        return read_twin(blob, twin) if twin.type == 'blob' else None
 
     def mergetree(self, tree, globalspace=None):
-        for item in tree.traverse():
-            if item.type == 'blob' and blob_readable(item):
-                self.mergeblob(item, globalspace)
+        # breadth first like tree.traverse(), so merge order is unchanged,
+        # but only config blobs are kept and nothing else is looked at
+        groups = []
+        pending = deque([tree])
+        while pending:
+            t = pending.popleft()
+            pending.extend(t.trees)
+            blobs = [blob for blob in t.blobs if _handler(blob.name) is not None]
+            if blobs:
+                groups.append(blobs)
+        self._repo.prefetch(tree, [blob for blobs in groups for blob in blobs])
+        for blobs in groups:
+            # decode the JSON files up front to tell precompiled twins apart
+            parsed = {}
+            for blob in blobs:
+                if _handler(blob.name) is _load_json:
+                    try:
+                        parsed[blob.name] = read_json(blob)
+                    except ValueError:
+                        pass  # mergeblob warns about it
+            for blob in blobs:
+                if blob.name in parsed:
+                    c, source = parsed[blob.name]
+                    # a twin, current or stale, only ever stands in for its yaml
+                    if source is None:
+                        self.mergedata(blob, c)
+                    continue
+                twin = parsed.get(json_twin(blob.name))
+                if twin is not None and twin[1] == blob.hexsha:
+                    self.mergedata(blob, twin[0])
+                else:
+                    self.mergeblob(blob, globalspace)
+
+    def mergedata(self, blob, c):
+        """Merge the already decoded contents `c` of `blob`."""
+        try:
+            self.update(c)
+        except Exception as ex:
+            warnings.warn(f"BlobConfig: error reading {blob.path}: {type(ex)} ({ex}).")
+            return False
+        return True
 
     def mergeblob(self, blob, globalspace=None):
         """Merge in a Python syntax configuration file that should assign
@@ -207,10 +565,10 @@ class BlobConfig(ConfigHolder):
         gb["sys"] = sys # in case config stuff needs these.
         gb["os"] = os
         try:
-            read_blob(blob, gb, self)
-        except:
-            ex, val, tb = sys.exc_info()
-            warnings.warn("BlobConfig: error reading blob: %s (%s)." % (ex, val))
+            return read_blob(blob, gb, self)
+        except Exception as ex:
+            warnings.warn(f"BlobConfig: error reading {blob.path}: {type(ex)} ({ex}).")
+            return False
 
 
 def check_config(fname):
@@ -240,7 +598,8 @@ def get_config(fname, branch='master', repo_path=None, initdict=None, globalspac
     if initdict:
         cf.update(initdict)
     cf.update(kwargs)
-    cf.set_repo(repo_path=repo_path, branch=branch)
+    # a clone about to be cleaned up must not be shared with other configs
+    cf.set_repo(repo_path=repo_path, branch=branch, shared=not cleanup)
     cf.sync_config(fname, globalspace=globalspace)
     if cleanup:
         cf._repo.cleanup()
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+gitfig-precompile: write a JSON twin next to every yaml config of a
+checked out config repo, gitfig reads the twin instead of parsing yaml
+as long as the yaml file is the one the twin was generated from.
+
+"""
+
+import argparse
+import json
+import os
+import sys
+
+import git
+import yaml
+
+from .blobconfig import TWIN_KEY, _SafeLoader, json_twin
+
+
+def iter_yaml(root):
+    for dirpath, dirnames, filenames in os.walk(root):
+        if '.git' in dirnames:
+            dirnames.remove('.git')
+        for name in sorted(filenames):
+            if json_twin(name) is not None:
+                yield os.path.join(dirpath, name)
+
+def check_keys(c, where='top level'):
+    # json.dumps would silently turn 1, None or True keys into strings
+    if isinstance(c, dict):
+        for key, val in c.items():
+            if not isinstance(key, str):
+                raise TypeError(f"non-string key {key!r} at {where}")
+            check_keys(val, f"{where} -> {key}")
+    elif isinstance(c, list):
+        for i, val in enumerate(c):
+            check_keys(val, f"{where} -> [{i}]")
+
+def is_twin(text):
+    try:
+        c = json.loads(text)
+    except ValueError:
+        return False
+    return isinstance(c, dict) and TWIN_KEY in c
+
+def render(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    c = yaml.load(data, Loader=_SafeLoader)
+    if not isinstance(c, dict):
+        raise TypeError(f"top level is a {type(c).__name__}, not a mapping")
+    check_keys(c)
+    # mark the twin with the git blob sha of its source, so gitfig only
+    # uses it in place of this exact yaml content; hashed by git so eol
+    # conversion and clean filters apply as they do on commit
+    dirname, name = os.path.split(path)
+    source = git.Git(dirname or '.').hash_object(f'--path={name}', name)
+    # allow_nan=False: .inf/.nan would become Infinity/NaN, which is not
+    # valid JSON and costs the fast decoder a fallback to stdlib json
+    return json.dumps({TWIN_KEY: source, **c}, indent=2, ensure_ascii=False, allow_nan=False) + '\n'
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='gitfig-precompile', description=__doc__.strip())
+    parser.add_argument('root', nargs='?', default='.', help='config repo checkout (default: .)')
+    parser.add_argument('--check', action='store_true',
+                        help='do not write, exit 1 if any JSON twin is missing or stale')
+    args = parser.parse_args(argv)
+
+    failed = False
+    seen = {}
+    for path in iter_yaml(args.root):
+        twin = os.path.join(os.path.dirname(path), json_twin(os.path.basename(path)))
+        if twin in seen:
+            print(f'{path}: twin {twin} is also generated from {seen[twin]}', file=sys.stderr)
+            failed = True
+            continue
+        seen[twin] = path
+        try:
+            data = render(path)
+        except (yaml.YAMLError, git.GitCommandError, TypeError, ValueError) as ex:
+            print(f'{path}: {ex}', file=sys.stderr)
+            failed = True
+            continue
+        try:
+            with open(twin, encoding='utf-8') as f:
+                current = f.read()
+        except FileNotFoundError:
+            current = None
+        if current == data:
+            continue
+        if current is not None and not is_twin(current):
+            print(f'{twin}: not generated by gitfig-precompile, leaving it alone', file=sys.stderr)
+            failed = True
+            continue
+        if args.check:
+            print(f'{twin}: stale', file=sys.stderr)
+            failed = True
+        else:
+            with open(twin, 'w', encoding='utf-8') as f:
+                f.write(data)
+            print(twin)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,10 +4,20 @@ setup(
     name='gitfig',
     version='0.1.4',
     packages=find_packages(),
+    python_requires='>=3.6',
     install_requires=[
         'gitpython',
         'PyYaml',
     ],
+    extras_require={
+        # msgspec needs python 3.8, older ones use stdlib json
+        'fast': ['msgspec; python_version >= "3.8"'],
+    },
+    entry_points={
+        'console_scripts': [
+            'gitfig-precompile=gitfig.precompile:main',
+        ],
+    },
     author='André Carneiro',
     author_email='acarneiro.dev@gmail.com',
     classifiers=[
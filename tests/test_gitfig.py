@@ -0,0 +1,278 @@
+import copy
+import json
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+import threading
+
+import git
+import pytest
+
+from gitfig import blobconfig, get_config
+from gitfig.blobconfig import ConfigHolder, ConfigLockError, ConfigReadError, TWIN_KEY
+from gitfig.precompile import main as precompile, render
+
+
+def run(*args, cwd):
+    return subprocess.run(['git', *args], cwd=cwd, check=True, stdout=subprocess.PIPE,
+                          universal_newlines=True).stdout.strip()
+
+
+class Origin(object):
+    """A work repo pushing to a bare origin served over file://"""
+    def __init__(self, root):
+        self.work = str(root / 'work')
+        self.bare = str(root / 'origin.git')
+        self.url = 'file://' + self.bare
+        os.makedirs(self.work)
+        run('init', '-q', cwd=self.work)
+        run('symbolic-ref', 'HEAD', 'refs/heads/master', cwd=self.work)
+
+    def write(self, files):
+        for path, content in files.items():
+            path = os.path.join(self.work, path)
+            if content is None:
+                os.remove(path)
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(content)
+
+    def commit(self, files=None):
+        self.write(files or {})
+        run('add', '-A', cwd=self.work)
+        run('commit', '-qm', 'update', cwd=self.work)
+        if not os.path.exists(self.bare):
+            run('clone', '-q', '--bare', self.work, self.bare, cwd=self.work)
+            run('config', 'uploadpack.allowFilter', 'true', cwd=self.bare)
+        else:
+            run('push', '-q', self.bare, 'master', cwd=self.work)
+
+
+@pytest.fixture(autouse=True)
+def isolated(tmp_path, monkeypatch):
+    tmp = tmp_path / 'tmp'
+    tmp.mkdir()
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmp))
+    monkeypatch.setenv('TMPDIR', str(tmp))
+    for var in ('AUTHOR', 'COMMITTER'):
+        monkeypatch.setenv(f'GIT_{var}_NAME', 'gitfig')
+        monkeypatch.setenv(f'GIT_{var}_EMAIL', 'gitfig@example.com')
+    monkeypatch.setattr(blobconfig, '_repos', {})
+    monkeypatch.setattr(blobconfig, '_repo_locks', {})
+
+
+@pytest.fixture
+def origin(tmp_path):
+    o = Origin(tmp_path)
+    o.commit({
+        'prod/app/base.yaml': 'foo: bar\nn: 1\n',
+        'prod/app/extra.json': '{"j": [1, 2]}',
+        'prod/app/code.py': 's = SECTION("s")\ns.k = os.sep\nx = 5\n',
+        'docs/readme.md': 'not a config\n',
+    })
+    return o
+
+
+def expire(cf):
+    cf._repo._last_fetch -= cf._repo.fetch_interval
+
+
+def test_file_and_directory(origin):
+    cf = get_config('prod/app/base.yaml', repo_path=origin.url, initdict={'lol': 1})
+    assert dict(cf) == {'lol': 1, 'foo': 'bar', 'n': 1}
+    cf = get_config(['prod', 'app'], repo_path=origin.url)
+    assert (cf.foo, cf.j, cf.x, cf.s.k) == ('bar', [1, 2], 5, os.sep)
+    with pytest.raises(ConfigReadError):
+        get_config('prod/nope.yaml', repo_path=origin.url)
+    with pytest.raises(ConfigReadError):
+        get_config('prod/app/base.yaml/x', repo_path=origin.url)
+
+
+def test_get_dynamic_reloads_after_push(origin):
+    cf = get_config('prod/app/base.yaml', repo_path=origin.url)
+    origin.commit({'prod/app/base.yaml': 'foo: bar\nn: 2\n'})
+    assert cf.get_dynamic('n') == 1
+    expire(cf)
+    assert cf.get_dynamic('n') == 2
+
+
+def test_failed_fetch_keeps_refs(origin):
+    cf = get_config('prod/app/base.yaml', repo_path=origin.url)
+    os.rename(origin.bare, origin.bare + '.off')
+    expire(cf)
+    with pytest.warns(UserWarning, match='fetching'):
+        assert cf.get_dynamic('n') == 1
+
+
+def test_shared_clone_is_reused(origin):
+    a = get_config('prod/app/base.yaml', repo_path=origin.url)
+    b = get_config('prod/app', repo_path=origin.url)
+    assert a._repo is b._repo
+    assert a._repo._repo_dir.startswith(blobconfig._cache_dir())
+    assert oct(os.stat(blobconfig._cache_dir()).st_mode & 0o777) == '0o700'
+
+
+def test_planted_clone_is_not_used(origin, tmp_path):
+    other = Origin(tmp_path / 'other')
+    other.commit({'prod/app/base.yaml': 'p: PWNED\n'})
+    planted = os.path.join(blobconfig._cache_dir(), blobconfig.sha1(origin.url.encode()).hexdigest())
+    run('clone', '-q', other.bare, planted, cwd=str(tmp_path))
+    assert dict(get_config('prod/app/base.yaml', repo_path=origin.url)) == {'foo': 'bar', 'n': 1}
+
+
+def test_unsafe_cache_dir_is_refused():
+    os.chmod(blobconfig._cache_dir(), 0o755)
+    with pytest.raises(blobconfig.BasicConfigError):
+        blobconfig._cache_dir()
+
+
+def test_cleanup_uses_a_private_clone(origin):
+    a = get_config('prod/app/base.yaml', repo_path=origin.url)
+    b = get_config('prod/app', repo_path=origin.url, cleanup=True)
+    assert b._repo is not a._repo
+    assert not os.path.exists(b._repo._repo_dir)
+    expire(a)
+    assert a.get_dynamic('foo') == 'bar'
+
+
+def test_concurrent_threads(origin):
+    results, errors = [], []
+
+    def load():
+        try:
+            results.append(get_config('prod/app/extra.json', repo_path=origin.url).j)
+        except Exception as ex:
+            errors.append(ex)
+
+    threads = [threading.Thread(target=load) for _ in range(6)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+    assert results == [[1, 2]] * 6
+
+
+def test_concurrent_processes_after_push(origin):
+    get_config('prod/app/base.yaml', repo_path=origin.url)
+    origin.commit({'prod/app/base.yaml': 'foo: bar\nn: 2\n'})
+    code = ('import sys; sys.path.insert(0, sys.argv[1]); from gitfig import get_config; '
+            'print(get_config("prod/app/base.yaml", repo_path=sys.argv[2]).n)')
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    procs = [subprocess.Popen([sys.executable, '-c', code, root, origin.url], stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE, universal_newlines=True) for _ in range(6)]
+    outs = [p.communicate() for p in procs]
+    assert [p.returncode for p in procs] == [0] * 6, outs
+    assert [out.strip() for out, err in outs] == ['2'] * 6
+
+
+def test_directory_load_prefetches_blobs(origin):
+    cf = get_config('prod/app/base.yaml', repo_path=origin.url)
+    repo = cf._repo._repo
+    tree = repo.commit('origin/master').tree['prod']['app']
+
+    def missing():
+        objects = repo.git.rev_list('--objects', '--missing=print', tree.hexsha).split()
+        return {o[1:] for o in objects if o[0] == '?'}
+
+    assert missing()
+    cf.sync_config('prod/app')
+    assert missing() == set()
+
+
+def test_prefetch_failure_falls_back(origin, monkeypatch):
+    def fetch(self, *args, **kwargs):
+        if '--no-write-fetch-head' in args:
+            raise git.GitCommandError(['git', 'fetch'], 129)
+        return self._call_process('fetch', *args, **kwargs)
+    monkeypatch.setattr(git.Git, 'fetch', fetch, raising=False)
+    assert get_config('prod/app', repo_path=origin.url).j == [1, 2]
+
+
+def precompiled(origin, files):
+    origin.write(files)
+    precompile([origin.work])
+    with open(os.path.join(origin.work, 'conf/x.json')) as f:
+        return json.load(f)
+
+
+def test_current_twin_replaces_yaml(origin):
+    twin = precompiled(origin, {'conf/x.yaml': 'a: 1\n'})
+    # prove the twin is what gets read
+    twin['from_twin'] = True
+    origin.commit({'conf/x.json': json.dumps(twin)})
+    assert dict(get_config('conf/x.yaml', repo_path=origin.url)) == {'a': 1, 'from_twin': True}
+    assert dict(get_config('conf', repo_path=origin.url)) == {'a': 1, 'from_twin': True}
+
+
+def test_stale_twin_is_ignored(origin):
+    precompiled(origin, {'conf/x.yaml': 'old: 9\n'})
+    origin.commit({'conf/x.yaml': 'a: 5\n'})
+    assert dict(get_config('conf/x.yaml', repo_path=origin.url)) == {'a': 5}
+    assert dict(get_config('conf', repo_path=origin.url)) == {'a': 5}
+
+
+def test_handwritten_json_is_a_regular_config(origin):
+    origin.commit({'conf/s.yaml': 'k: yaml\ny: 1\n', 'conf/s.json': '{"k": "json", "z": 2}'})
+    assert dict(get_config('conf/s.yaml', repo_path=origin.url)) == {'k': 'yaml', 'y': 1}
+    assert dict(get_config('conf', repo_path=origin.url)) == {'k': 'yaml', 'y': 1, 'z': 2}
+
+
+def test_precompile_check_and_handwritten(origin, capsys):
+    origin.write({'conf/x.yaml': 'a: 1\n', 'conf/s.yaml': 'b: 2\n', 'conf/s.json': '{"mine": 1}'})
+    assert precompile([origin.work, '--check']) == 1
+    assert precompile([origin.work]) == 1  # s.json is reported, not overwritten
+    with open(os.path.join(origin.work, 'conf/s.json')) as f:
+        assert json.load(f) == {'mine': 1}
+    os.remove(os.path.join(origin.work, 'conf/s.json'))
+    assert precompile([origin.work]) == 0
+    assert precompile([origin.work, '--check']) == 0
+
+
+@pytest.mark.parametrize('content', ['n: .inf\n', 'n: .nan\n', '1: a\n', 'x: {null: 1}\n', '- 1\n'])
+def test_render_rejects_non_json(tmp_path, content):
+    path = tmp_path / 'x.yaml'
+    path.write_text(content)
+    with pytest.raises((TypeError, ValueError)):
+        render(str(path))
+
+
+def test_twin_sha_matches_committed_blob_with_autocrlf(origin):
+    run('config', 'core.autocrlf', 'true', cwd=origin.work)
+    twin = precompiled(origin, {'conf/x.yaml': 'a: 1\r\nb: 2\r\n'})
+    origin.commit()
+    assert twin[TWIN_KEY] == run('rev-parse', 'HEAD:conf/x.yaml', cwd=origin.work)
+    assert precompile([origin.work, '--check']) == 0
+
+
+@pytest.mark.parametrize('data, expected', [
+    (b'\xef\xbb\xbf{"a": 1}', {'a': 1}),
+    (b'{"a": NaN}', None),
+    (b'{"a": 123456789012345678901234567890}', {'a': 123456789012345678901234567890}),
+])
+def test_json_decodes_like_stdlib(data, expected):
+    c = blobconfig._decode_json(data)
+    if expected is None:
+        assert c['a'] != c['a']
+    else:
+        assert c == expected
+
+
+def test_config_holder_lock_copy_pickle():
+    c = ConfigHolder({'a': 1})
+    c.add_section('s')
+    c.s.k = 3
+    c.lock()
+    c.a = 2
+    c.update(a=3)
+    with pytest.raises(ConfigLockError):
+        c.b = 1
+    with pytest.raises(ConfigLockError):
+        c.update(b=1)
+    assert not hasattr(c, 'missing')
+    for other in [copy.deepcopy(c)] + [pickle.loads(pickle.dumps(c, p)) for p in range(pickle.HIGHEST_PROTOCOL + 1)]:
+        assert other == c and other.islocked()
+        assert type(other.s) is blobconfig.SECTION and other.s._name == 's'